@@ -19,46 +19,70 @@
 
 import os
 import sys
+import asyncio
 import re
 import getpass
 import shutil
-import queue
+import stat
+import tempfile
+import zipfile
+import sqlite3
+import hashlib
+import random
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from ollama import chat
+from ollama import AsyncClient
 
 # prompt_toolkit for the radio dialog
 try:
-    from prompt_toolkit import prompt
-    from prompt_toolkit.application import Application
+    from prompt_toolkit import prompt, PromptSession
+    from prompt_toolkit.application import Application, run_in_terminal
     from prompt_toolkit.application.current import get_app
     from prompt_toolkit.layout import Layout
     from prompt_toolkit.layout.containers import HSplit, VSplit, Window, WindowAlign
     from prompt_toolkit.widgets import Dialog, Button, Label, RadioList
     from prompt_toolkit.styles import Style
     from prompt_toolkit.key_binding import KeyBindings
+    from prompt_toolkit.patch_stdout import StdoutProxy
 except ImportError:
     print("(C) IURII TRUKHIN, yuri@trukhin.com, 2024")
     print("prompt_toolkit is missing. Please install it: pip install prompt_toolkit")
     sys.exit(1)
 
-# tqdm for progress bar
+# rich for pretty console output
 try:
-    from tqdm import tqdm
+    from rich.console import Console, Group
+    from rich.live import Live
+    from rich.markdown import Markdown
+    from rich.panel import Panel
+    from rich.segment import Segments
+    from rich.text import Text
 except ImportError:
-    print("tqdm is missing. Please install it: pip install tqdm")
+    print("rich is missing. Please install it: pip install rich")
     sys.exit(1)
 
-# rich for pretty console output
+# numpy for the semantic cache similarity search
 try:
-    from rich.console import Console
-    from rich.markdown import Markdown
+    import numpy as np
 except ImportError:
-    print("rich is missing. Please install it: pip install rich")
+    print("numpy is missing. Please install it: pip install numpy")
     sys.exit(1)
 
+# zstandard to compress answers cached on disk
+try:
+    import zstandard as zstd
+except ImportError:
+    print("zstandard is missing. Please install it: pip install zstandard")
+    sys.exit(1)
 
+# sqlite-vec for looking up similar cached questions on disk (optional)
+try:
+    import sqlite_vec
+except ImportError:
+    sqlite_vec = None
 
 # tiktoken for token counting
 try:
@@ -76,29 +100,84 @@ except ImportError:
     from langchain.embeddings import OllamaEmbeddings
     from langchain_community.vectorstores import Chroma
 
+# Optional second retrieval stage: cross-encoder reranking of the candidates.
+try:
+    from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+except ImportError:
+    HuggingFaceCrossEncoder = None
+
 console = Console()
 
+# Read once: new files written by update_file_contents get the usual mode.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+# Loaded once per process and shared across index switches.
+_ENC = None
+_EMBEDDINGS = {}
+_CROSS_ENCODERS = {}
+
 NUM_WORKERS = 4
-QUEUE_SIZE = 100
+# Questions answered concurrently; Ollama batches them if OLLAMA_NUM_PARALLEL > 1.
+MAX_CONCURRENT_QUESTIONS = 32
 MAX_TOKENS = 128_000
 MAX_RETRIES = 5
 INITIAL_DELAY = 1.0
-K = 100
-
-global_lock = threading.Lock()
+MAX_DELAY = 30.0
+MODEL = "llama3.2-vision:latest"
+# Retrieval: FETCH_K nearest candidates, of which maximal marginal relevance
+# keeps K that are relevant but not near-duplicates of each other.
+FETCH_K = 200
+K = 40
+MMR_LAMBDA = 0.5
+# Candidates kept after cross-encoder reranking (when it is available).
+RERANK_TOP_N = 20
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+# tiktoken releases the GIL while encoding, so batches can use every core.
+ENCODE_THREADS = os.cpu_count() or 4
+# Fraction of MAX_TOKENS kept free when budgeting context by estimated size.
+TOKEN_HEADROOM = 0.05
+
+# The FETCH_K candidates are found by scanning int8-quantized embeddings.
+INT8_INDEX_FILE = "int8_embeddings.npz"
+INT8_BUILD_BATCH = 5000
+INT8_SCAN_BLOCK = 1024
+
+# Live panels of the questions in flight: how many are shown, and how tall.
+MAX_STREAM_PANELS = 4
+STREAM_PANEL_HEIGHT = 8
+# Characters of a streaming answer kept for its panel.
+STREAM_TAIL_CHARS = 4096
+
+SYSTEM_PREFIX = "You are a code assistant. Use the provided context:\n\nContext:\n"
+
+# Semantic cache: a new question whose embedding has cosine similarity >= the
+# threshold with a previously answered one reuses that answer.
+SEM_CACHE_THRESHOLD = 0.87
+SEM_CACHE_SIZE = 512
+QA_CACHE_FILE = "qa_cache.sqlite"
 
 
 # ------------------------------------------------------------------------------
 # Utility functions
 # ------------------------------------------------------------------------------
 
+_INDEX_NAME_RE = re.compile(
+    r"^(?P<name>.+)_(?P<date>\d{8})_(?P<time>\d{6})_(?P<guid>[0-9a-fA-F]+)$"
+)
+_WHITESPACE_RE = re.compile(r"\s+")
+_FILE_UPDATE_RE = re.compile(
+    r"\[FILE_UPDATE\]\s*filename:\s*(.+?)\s*code:\s*(.+?)\[\/FILE_UPDATE\]",
+    flags=re.DOTALL
+)
+
+
 def parse_date_time(index_name: str):
     """
     Attempts to parse a string like 'projectName_YYYYmmdd_HHMMSS_guid'
     and returns (projectName, 'YYYY-mm-dd HH:MM') or a fallback.
     """
-    pattern = r"^(?P<name>.+)_(?P<date>\d{8})_(?P<time>\d{6})_(?P<guid>[0-9a-fA-F]+)$"
-    match = re.match(pattern, index_name)
+    match = _INDEX_NAME_RE.match(index_name)
     if not match:
         return index_name, ""
     proj = match.group("name") or "project"
@@ -125,135 +204,838 @@ def parse_file_update_instructions(answer: str):
 
     Returns a list of tuples (filename, new_code).
     """
-    pattern = re.compile(
-        r"\[FILE_UPDATE\]\s*filename:\s*(.+?)\s*code:\s*(.+?)\[\/FILE_UPDATE\]",
-        flags=re.DOTALL
-    )
-    matches = pattern.findall(answer)
-    results = []
-    for fname, code in matches:
-        fname = fname.strip()
-        code = code.strip()
-        results.append((fname, code))
-    return results
+    return [(fname.strip(), code.strip()) for fname, code in _FILE_UPDATE_RE.findall(answer)]
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token count estimate: cl100k averages about 4 characters per token
+    for English and code, plus a few tokens for the document header.
+    """
+    return (len(text) >> 2) + 8
+
+
+def maximal_marginal_relevance(query_embedding, embeddings, k: int, lambda_mult: float = MMR_LAMBDA):
+    """
+    Picks up to k rows of embeddings that are similar to query_embedding but
+    not to each other. lambda_mult=1 ranks by relevance only, 0 by diversity only.
+    Returns the row indices in the order they were picked.
+    """
+    vectors = np.asarray(embeddings, dtype=np.float32)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    q = np.asarray(query_embedding, dtype=np.float32)
+    q = q / (np.linalg.norm(q) or 1.0)
+
+    relevance = vectors @ q
+    picked = [int(np.argmax(relevance))]
+    redundancy = vectors @ vectors[picked[0]]
+    while len(picked) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[picked] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        redundancy = np.maximum(redundancy, vectors @ vectors[best])
+    return picked
+
+
+def render_markdown(text: str):
+    """
+    Renders text as Markdown for the console and returns the rendered lines,
+    ready to be printed without parsing the Markdown again.
+    """
+    lines = console.render_lines(Markdown(text), console.options, new_lines=True)
+    return Segments([segment for line in lines for segment in line])
+
+
+def count_within_budget(token_counts, used_tokens: int, limit: int) -> int:
+    """
+    Returns how many leading items of token_counts fit into limit when
+    used_tokens are already taken.
+    """
+    totals = np.cumsum(token_counts) + used_tokens
+    return int(np.searchsorted(totals, limit, side="right"))
 
 
 def update_file_contents(file_path: str, new_content: str):
     """
-    Overwrites file_path with new_content. Creates directories if needed.
+    Atomically replaces file_path with new_content: the content is written to
+    a temporary file in the same directory, which is then renamed over
+    file_path, so the file is never left half-written. Creates directories if
+    needed and keeps the permissions of an existing file. A symlink is
+    followed, so its target is replaced rather than the link itself.
     """
+    file_path = os.path.realpath(file_path)
     parent_dir = os.path.dirname(file_path)
-    if parent_dir and not os.path.exists(parent_dir):
-        os.makedirs(parent_dir, exist_ok=True)
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(new_content)
+    os.makedirs(parent_dir, exist_ok=True)
+    try:
+        mode = stat.S_IMODE(os.stat(file_path).st_mode)
+    except FileNotFoundError:
+        mode = 0o666 & ~_UMASK
+
+    data = memoryview(new_content.encode("utf-8"))
+    fd, tmp_path = tempfile.mkstemp(dir=parent_dir, prefix=".prodify-")
+    try:
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def get_encoding():
+    """
+    Returns the cl100k_base tokenizer, loading it on first use. The first load
+    may download the BPE file, so it happens only once an index is chosen.
+    """
+    global _ENC
+    if _ENC is None:
+        _ENC = tiktoken.get_encoding("cl100k_base")
+    return _ENC
+
+
+def get_embeddings(model_name: str = MODEL):
+    """
+    Returns the OllamaEmbeddings for model_name, creating it on first use.
+    """
+    embeddings = _EMBEDDINGS.get(model_name)
+    if embeddings is None:
+        embeddings = _EMBEDDINGS[model_name] = OllamaEmbeddings(model=model_name)
+    return embeddings
+
+
+# ------------------------------------------------------------------------------
+# Retrieval
+# ------------------------------------------------------------------------------
+
+class Int8VectorIndex:
+    """
+    An int8 copy of a collection's embeddings for the first retrieval stage.
+    Vectors are L2-normalized and stored as int8 codes with one float scale
+    per vector, a quarter of the memory of Chroma's float32 vectors. The copy
+    is built once per index and saved next to it in INT8_INDEX_FILE.
+    """
+
+    def __init__(self, ids, codes, scales):
+        self.ids = ids
+        self.codes = codes
+        self.scales = scales
+
+    @staticmethod
+    def quantize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms > 0, norms, 1.0)
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.rint(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+
+    @classmethod
+    def load_or_build(cls, collection, path):
+        """
+        Loads the int8 copy from path, (re)building it from the collection if
+        it is missing, unreadable or out of date. Returns None for an empty
+        collection.
+        """
+        count = collection.count()
+        if not count:
+            return None
+        if os.path.isfile(path):
+            try:
+                with np.load(path) as data:
+                    if len(data["ids"]) == count:
+                        return cls(data["ids"].tolist(), data["codes"], data["scales"])
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                console.print(f"Cannot read the int8 vector index ({e}), rebuilding it.", style="yellow")
+
+        console.print("Building int8 vector index...", style="dim")
+        ids, codes, scales = [], [], []
+        for offset in range(0, count, INT8_BUILD_BATCH):
+            batch = collection.get(include=["embeddings"], limit=INT8_BUILD_BATCH, offset=offset)
+            batch_codes, batch_scales = cls.quantize(batch["embeddings"])
+            ids.extend(batch["ids"])
+            codes.append(batch_codes)
+            scales.append(batch_scales)
+        index = cls(ids, np.concatenate(codes), np.concatenate(scales))
+        try:
+            index.save(path)
+        except OSError as e:
+            console.print(f"Cannot save the int8 vector index ({e}), it is rebuilt next time.", style="yellow")
+        return index
+
+    def save(self, path):
+        """
+        Atomically writes the index to path, like update_file_contents, so a
+        crash while saving never leaves a truncated file behind.
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".int8-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, ids=np.array(self.ids), codes=self.codes, scales=self.scales)
+            os.chmod(tmp_path, 0o666 & ~_UMASK)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def search(self, q_emb, n):
+        """
+        Returns the ids of the n vectors closest to q_emb by cosine similarity.
+        """
+        q = np.asarray(q_emb, dtype=np.float32)
+        q = q / (np.linalg.norm(q) or 1.0)
+        sims = np.empty(len(self.ids), dtype=np.float32)
+        # Dequantize block by block to keep the temporary float copy small.
+        for start in range(0, len(self.ids), INT8_SCAN_BLOCK):
+            block = self.codes[start:start + INT8_SCAN_BLOCK]
+            sims[start:start + len(block)] = block.astype(np.float32) @ q
+        sims *= self.scales
+        n = min(n, len(sims))
+        top = np.argpartition(sims, -n)[-n:]
+        return [self.ids[i] for i in top]
+
+
+class CodeRetriever:
+    """
+    Two-stage retrieval straight from the Chroma collection:
+      1) FETCH_K candidates for a precomputed query embedding (the same one
+         the semantic cache uses), found by scanning the int8 index (or by
+         Chroma's own nearest-neighbour query if there is none), narrowed to
+         K diverse documents by maximal marginal relevance on their exact
+         embeddings
+      2) optional cross-encoder reranking down to RERANK_TOP_N documents
+    Results are plain (source, content) tuples instead of LangChain Documents.
+    """
+
+    def __init__(self, db, embeddings, cross_encoder=None, int8_index=None):
+        self.collection = db._collection
+        self.embeddings = embeddings
+        self.cross_encoder = cross_encoder
+        self.int8_index = int8_index
+
+    def embed(self, query):
+        return self.embeddings.embed_query(query)
+
+    def search(self, query, q_emb):
+        if self.int8_index is not None:
+            ids = self.int8_index.search(q_emb, FETCH_K)
+            raw = self.collection.get(ids=ids, include=["documents", "metadatas", "embeddings"])
+            texts, metas, vectors = raw["documents"], raw["metadatas"], raw["embeddings"]
+        else:
+            raw = self.collection.query(
+                query_embeddings=[q_emb],
+                n_results=FETCH_K,
+                include=["documents", "metadatas", "embeddings"]
+            )
+            texts, metas, vectors = raw["documents"][0], raw["metadatas"][0], raw["embeddings"][0]
+        if not texts:
+            return []
+
+        docs = [
+            ((metas[i] or {}).get("source", "unknown"), texts[i])
+            for i in maximal_marginal_relevance(q_emb, vectors, K)
+        ]
+        if self.cross_encoder is not None:
+            scores = self.cross_encoder.score([(query, text) for _, text in docs])
+            best = np.argsort(scores)[::-1][:RERANK_TOP_N]
+            docs = [docs[i] for i in best]
+        return docs
+
+
+def build_retriever(db, embeddings, persist_dir):
+    """
+    Returns a CodeRetriever for db, backed by the index's int8 copy of the
+    embeddings. Its candidates are reranked by a small cross-encoder if
+    sentence-transformers is installed.
+    """
+    int8_index = Int8VectorIndex.load_or_build(
+        db._collection, os.path.join(persist_dir, INT8_INDEX_FILE)
+    )
+    cross_encoder = None
+    if HuggingFaceCrossEncoder is not None:
+        try:
+            cross_encoder = _CROSS_ENCODERS.get(RERANK_MODEL)
+            if cross_encoder is None:
+                cross_encoder = _CROSS_ENCODERS[RERANK_MODEL] = HuggingFaceCrossEncoder(
+                    model_name=RERANK_MODEL
+                )
+        except Exception as e:
+            # sentence-transformers missing, or the model cannot be downloaded
+            console.print(
+                f"Cannot load the reranker ({e}), answers use all retrieved documents. "
+                "To rerank them, install sentence-transformers: pip install sentence-transformers",
+                style="yellow"
+            )
+    return CodeRetriever(db, embeddings, cross_encoder, int8_index)
+
+
+def prepare_query(query, retriever, sem_cache):
+    """
+    Runs in the retrieval pool. A question already asked with different case,
+    whitespace or punctuation is answered from the cache without any model
+    call. Otherwise it is embedded once, then either found in the semantic
+    cache or its documents are retrieved with that embedding.
+    Returns (q_emb, cached, docs); cached is None on a cache miss.
+    """
+    cached = sem_cache.lookup_text(query)
+    if cached:
+        return None, cached, []
+    q_emb = retriever.embed(query)
+    cached = sem_cache.lookup(q_emb) or sem_cache.lookup_stored(query, q_emb)
+    if cached:
+        return q_emb, cached, []
+    return q_emb, None, retriever.search(query, q_emb)
+
+
+# ------------------------------------------------------------------------------
+# Semantic cache of answered questions
+# ------------------------------------------------------------------------------
+
+class SemanticCache:
+    """
+    Keeps L2-normalized query embeddings in a (N, D) matrix next to a parallel
+    list of (answer, file_updates). A lookup is a single matrix-vector product;
+    the least recently used entry is evicted once max_entries is reached.
+
+    Every entry is also indexed by a fingerprint of its normalized question
+    text, so a question that differs only in case, whitespace or trailing
+    punctuation is found without embedding it first.
+
+    Misses fall through to an optional QACacheStore, which keeps every answer
+    on disk across sessions. A store that cannot be read (locked or damaged
+    file) counts as a miss.
+    """
+
+    def __init__(self, store=None, threshold=SEM_CACHE_THRESHOLD, max_entries=SEM_CACHE_SIZE):
+        self.store = store
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        self._matrix = None
+        self._entries = []
+        self._fingerprints = []
+        self._by_fingerprint = {}
+        self._lru = deque()
+        self._store_warned = False
+
+    @staticmethod
+    def _normalize(embedding):
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+    @staticmethod
+    def fingerprint(query):
+        text = _WHITESPACE_RE.sub(" ", query.lower()).strip().rstrip("?!. ")
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest()
+
+    def _touch(self, slot):
+        self._lru.remove(slot)
+        self._lru.append(slot)
+        return self._entries[slot]
+
+    def lookup_text(self, query):
+        """
+        Returns the cached (answer, file_updates) of the same question up to
+        case, whitespace and trailing punctuation, or None. A hit in the store
+        is also added to the in-memory cache if its embedding is stored.
+        """
+        fp = self.fingerprint(query)
+        with self._lock:
+            slot = self._by_fingerprint.get(fp)
+            if slot is not None:
+                return self._touch(slot)
+        if self.store is None:
+            return None
+        stored = self._from_store(self.store.lookup_text, fp)
+        if stored is None:
+            return None
+        answer, q = stored
+        entry = (answer, parse_file_update_instructions(answer))
+        if q is not None:
+            self._remember(q, fp, entry)
+        return entry
+
+    def lookup(self, embedding):
+        """
+        Returns the cached (answer, file_updates) of the most similar question,
+        or None if nothing is similar enough.
+        """
+        q = self._normalize(embedding)
+        with self._lock:
+            size = len(self._entries)
+            if size and self._matrix.shape[1] == q.shape[0]:
+                sims = self._matrix[:size] @ q
+                best = int(np.argmax(sims))
+                if sims[best] >= self.threshold:
+                    return self._touch(best)
+        return None
+
+    def lookup_stored(self, query, embedding):
+        """
+        Like lookup, but searches the on-disk store. A hit is also added to
+        the in-memory cache.
+        """
+        if self.store is None:
+            return None
+        q = self._normalize(embedding)
+        answer = self._from_store(self.store.lookup, q, 1 - self.threshold)
+        if answer is None:
+            return None
+        entry = (answer, parse_file_update_instructions(answer))
+        self._remember(q, self.fingerprint(query), entry)
+        return entry
+
+    def _from_store(self, lookup, *args):
+        # The store is only a shortcut: on an error the question is answered
+        # as a miss. The warning is shown once per session.
+        try:
+            return lookup(*args)
+        except (sqlite3.Error, zstd.ZstdError) as e:
+            if not self._store_warned:
+                self._store_warned = True
+                console.print(f"Cannot read answers cached on disk: {e}", style="yellow")
+            return None
+
+    def add(self, query, embedding, answer, file_updates):
+        q = self._normalize(embedding)
+        fp = self.fingerprint(query)
+        self._remember(q, fp, (answer, file_updates))
+        if self.store is not None:
+            self.store.add(query, fp, q, answer)
+
+    def _remember(self, q, fp, entry):
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[1] != q.shape[0]:
+                self._matrix = np.zeros((self.max_entries, q.shape[0]), dtype=np.float32)
+                self._entries = []
+                self._fingerprints = []
+                self._by_fingerprint = {}
+                self._lru.clear()
+            if len(self._entries) < self.max_entries:
+                slot = len(self._entries)
+                self._entries.append(None)
+                self._fingerprints.append(None)
+            else:
+                slot = self._lru.popleft()
+                # The same question may have been added again into a newer slot.
+                old_fp = self._fingerprints[slot]
+                if self._by_fingerprint.get(old_fp) == slot:
+                    del self._by_fingerprint[old_fp]
+            self._matrix[slot] = q
+            self._entries[slot] = entry
+            self._fingerprints[slot] = fp
+            self._by_fingerprint[fp] = slot
+            self._lru.append(slot)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+
+
+class QACacheStore:
+    """
+    On-disk answers of an index, kept across sessions in QA_CACHE_FILE:
+      - answers(id, q, q_hash, ans_zstd, ts): zstd-compressed answers, found by
+        the fingerprint of the question text
+      - qa: a sqlite-vec vec0 table with the question embeddings (same rowid),
+        found by cosine distance. It is skipped if sqlite-vec is not installed
+        or this Python's sqlite3 cannot load extensions.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._compressor = zstd.ZstdCompressor()
+        self._decompressor = zstd.ZstdDecompressor()
+        self.vectors = False
+        if sqlite_vec is not None:
+            try:
+                self._conn.enable_load_extension(True)
+                sqlite_vec.load(self._conn)
+                self._conn.enable_load_extension(False)
+                self.vectors = True
+            except (AttributeError, sqlite3.OperationalError) as e:
+                console.print(
+                    f"Cannot load sqlite-vec ({e}), similar questions are not cached on disk.",
+                    style="yellow"
+                )
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS answers("
+            "id INTEGER PRIMARY KEY, q TEXT, q_hash BLOB, ans_zstd BLOB, ts INTEGER);"
+            "CREATE INDEX IF NOT EXISTS answers_q_hash ON answers(q_hash);"
+        )
+        self._has_qa = self.vectors and self._conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'qa'"
+        ).fetchone() is not None
+
+    def _answer(self, row_id):
+        row = self._conn.execute("SELECT ans_zstd FROM answers WHERE id = ?", (row_id,)).fetchone()
+        return None if row is None else self._decompressor.decompress(row[0]).decode("utf-8")
+
+    def lookup_text(self, fingerprint):
+        """
+        Returns (answer, embedding) of the latest question stored with this
+        fingerprint, or None. embedding is None without the qa table.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM answers WHERE q_hash = ? ORDER BY id DESC LIMIT 1", (fingerprint,)
+            ).fetchone()
+            if row is None:
+                return None
+            embedding = None
+            if self._has_qa:
+                vec = self._conn.execute(
+                    "SELECT embedding FROM qa WHERE rowid = ?", (row[0],)
+                ).fetchone()
+                if vec is not None:
+                    embedding = np.frombuffer(vec[0], dtype=np.float32)
+            return self._answer(row[0]), embedding
+
+    def lookup(self, q, max_distance):
+        """
+        Returns the answer of the nearest stored question if its cosine distance
+        to the normalized embedding q is at most max_distance, else None.
+        """
+        if not self._has_qa:
+            return None
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT rowid, distance FROM qa WHERE embedding MATCH ? AND k = 1",
+                    (q.tobytes(),)
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # Stored embeddings have another dimension (model changed)
+                return None
+            if row is None or row[1] > max_distance:
+                return None
+            return self._answer(row[0])
+
+    def add(self, query, fingerprint, q, answer):
+        with self._lock, self._conn:
+            cur = self._conn.execute(
+                "INSERT INTO answers(q, q_hash, ans_zstd, ts) VALUES (?, ?, ?, ?)",
+                (query, fingerprint, self._compressor.compress(answer.encode("utf-8")), int(time.time()))
+            )
+            if self.vectors:
+                if not self._has_qa:
+                    self._conn.execute(
+                        f"CREATE VIRTUAL TABLE IF NOT EXISTS qa USING "
+                        f"vec0(embedding float[{q.shape[0]}] distance_metric=cosine)"
+                    )
+                    self._has_qa = True
+                try:
+                    self._conn.execute(
+                        "INSERT INTO qa(rowid, embedding) VALUES (?, ?)", (cur.lastrowid, q.tobytes())
+                    )
+                except sqlite3.OperationalError:
+                    pass  # dimension mismatch: the answer stays findable by text only
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
 
 
 # ------------------------------------------------------------------------------
-# Worker class for handling user queries (Q:)
+# Handling user queries (Q:)
 # ------------------------------------------------------------------------------
 
-class AskWorker(threading.Thread):
+class QuestionHandler:
     """
-    A worker thread that processes user queries in the background:
-      1) Retrieves relevant documents from retriever
+    Answers user queries, each in its own asyncio task:
+      0) Waits for the retrieval pool, which looks the question up in the
+         semantic cache and prefetches its documents on a miss
+      1) Takes the prefetched documents
       2) Builds the context prompt
-      3) Calls OpenAI
+      3) Calls Ollama and streams the answer into the question's live panel
       4) Prints the answer
       5) Checks for [FILE_UPDATE] instructions and applies them if user confirms
+
+    Up to MAX_CONCURRENT_QUESTIONS requests are sent to Ollama at once, which
+    lets a server with OLLAMA_NUM_PARALLEL > 1 batch them together.
     """
 
-    def __init__(self, task_queue, retriever, enc):
-        super().__init__()
-        self.task_queue = task_queue
-        self.retriever = retriever
+    def __init__(self, client, enc, sem_cache, board):
+        self.client = client
         self.enc = enc
-        self.daemon = True
-
-    def run(self):
-        while True:
-            item = self.task_queue.get()
-            if item is None:
-                self.task_queue.task_done()
-                break
-
-            query, idx = item
-            self.process_query(query, idx)
-            self.task_queue.task_done()
+        self.sem_cache = sem_cache
+        self.board = board
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_QUESTIONS)
+        self.confirm_lock = asyncio.Lock()
+        self.system_prefix_tokens = len(enc.encode_ordinary(SYSTEM_PREFIX))
+
+    async def answer(self, query, idx, prepared):
+        self.board.show(idx, stream_panel(idx, query, status="queued"))
+        try:
+            async with self.semaphore:
+                await self.process_query(query, idx, prepared)
+        finally:
+            self.board.remove(idx)
+
+    async def process_query(self, query, idx, prepared):
+        self.board.show(idx, stream_panel(idx, query, status="retrieving"))
+
+        # 0) + 1) Semantic cache lookup or retrieved docs
+        try:
+            q_emb, cached, docs = await asyncio.wrap_future(prepared)
+        except Exception as e:
+            console.print(f"Error retrieving docs for question #{idx}: {e}", style="bold red")
+            return
+
+        if cached:
+            answer, updates = cached
+            console.print(f"(Question #{idx} answered from the semantic cache)", style="dim")
+            await self.print_answer(query, idx, answer, updates)
+            return
+
+        # 2) Build prompt
+        suffix = f"\nQuestion: {query}"
+        pieces = [
+            f"--- document {i} source: {source} ---\n{content}\n\n"
+            for i, (source, content) in enumerate(docs, start=1)
+        ]
+
+        # Budget pieces by their estimated size, keeping some headroom
+        # for estimation error.
+        budget = int(MAX_TOKENS * (1 - TOKEN_HEADROOM))
+        fixed_tokens = self.system_prefix_tokens + len(self.enc.encode_ordinary(suffix))
+        estimated = np.fromiter(
+            (estimate_tokens(p) for p in pieces), dtype=np.int64, count=len(pieces)
+        )
+        cutoff = count_within_budget(estimated, fixed_tokens, budget)
+        context_parts = pieces[:cutoff]
+
+        # A BPE token is at least one byte, so a context with fewer UTF-8
+        # bytes than the limit fits. Otherwise count it exactly and truncate.
+        max_tokens = fixed_tokens + sum(len(p.encode("utf-8")) for p in context_parts)
+        if max_tokens > MAX_TOKENS:
+            token_lists = await asyncio.to_thread(
+                self.enc.encode_ordinary_batch, context_parts, num_threads=ENCODE_THREADS
+            )
+            exact = np.fromiter(
+                (len(t) for t in token_lists), dtype=np.int64, count=len(token_lists)
+            )
+            del context_parts[count_within_budget(exact, fixed_tokens, MAX_TOKENS):]
 
-    def process_query(self, query, idx):
-        with global_lock:
-            console.print(f"\n[bold](Processing question #{idx})[/bold] Q: {query}", style="dim")
+        user_prompt = f"{SYSTEM_PREFIX}{''.join(context_parts)}{suffix}"
 
-        with tqdm(total=2, desc=f"Processing question #{idx}", unit="step") as pbar:
-            # 1) Retrieve docs
-            docs = []
+        # 3) Call Ollama, streaming tokens into the live panel as they arrive
+        self.board.show(idx, stream_panel(idx, query, status="waiting for the model"))
+        delay = INITIAL_DELAY
+        answer = None
+        for attempt in range(MAX_RETRIES):
             try:
-                docs = self.retriever.invoke(query)
+                resp = await self.client.chat(
+                    model=MODEL,
+                    messages=[{"role": "user", "content": user_prompt}],
+                    stream=True,
+                )
+                parts = []
+                tail = ""
+                async for chunk in resp:
+                    content = chunk.message.content or ""
+                    parts.append(content)
+                    tail = (tail + content)[-STREAM_TAIL_CHARS:]
+                    self.board.show(idx, stream_panel(idx, query, tail, "answering"))
+                answer = "".join(parts)
+                break
             except Exception as e:
-                with global_lock:
-                    console.print(f"Error retrieving docs: {e}", style="bold red")
-                return
-            pbar.update(1)
-
-            # 2) Build prompt
-            system_prefix = "You are a code assistant. Use the provided context:\n\nContext:\n"
-            suffix = f"\nQuestion: {query}"
-            base_msg = f"{system_prefix}<CONTEXT_PLACEHOLDER>{suffix}"
-            base_tokens = len(self.enc.encode(base_msg))
-
-            context_parts = []
-            current_tokens = base_tokens
-            for i, doc in enumerate(docs, start=1):
-                source = doc.metadata.get("source", "unknown")
-                piece = f"--- document {i} source: {source} ---\n{doc.page_content}\n\n"
-                piece_tokens = len(self.enc.encode(piece))
-                if current_tokens + piece_tokens > MAX_TOKENS:
-                    break
-                context_parts.append(piece)
-                current_tokens += piece_tokens
-
-            user_prompt = f"{system_prefix}{''.join(context_parts)}{suffix}"
-
-            # 3) Call Ollama
-            delay = INITIAL_DELAY
-            answer = None
-            for attempt in range(MAX_RETRIES):
-                try:
-                    resp = chat(
-                        model="llama3.2-vision:latest",
-                        messages=[{"role": "user", "content": user_prompt}],
+                if attempt == MAX_RETRIES - 1:
+                    console.print(
+                        f"Ollama error on question #{idx}: {e}. Max retries exceeded.",
+                        style="bold red"
                     )
-                    answer = resp.message.content
-                    break
-                except Exception as e:
-                    with global_lock:
-                        console.print(f"Unexpected error: {e}", style="bold red")
                     return
+                # Exponential backoff with jitter, so workers that failed
+                # together do not retry together.
+                wait = min(delay, MAX_DELAY) * (0.5 + random.random())
+                console.print(
+                    f"Ollama error on question #{idx}: {e}. Retrying in {wait:.1f}s "
+                    f"(attempt {attempt+1}/{MAX_RETRIES})...",
+                    style="yellow"
+                )
+                self.board.show(idx, stream_panel(idx, query, status="retrying"))
+                await asyncio.sleep(wait)
+                delay *= 2
+
+        updates = parse_file_update_instructions(answer) if answer else []
+        await self.print_answer(query, idx, answer, updates)
+        if answer:
+            try:
+                await asyncio.to_thread(self.sem_cache.add, query, q_emb, answer, updates)
+            except sqlite3.Error as e:
+                console.print(f"Answer #{idx} was not cached on disk: {e}", style="yellow")
 
-            pbar.update(1)
+    async def print_answer(self, query, idx, answer, updates):
+        if not answer:
+            console.print(
+                f"No answer was returned for question #{idx}. Something went wrong.",
+                style="bold red"
+            )
+            return
+
+        # 4) Print answer. Markdown is rendered in a thread; printing it is a
+        # single call, so answers of different workers never interleave.
+        self.board.show(idx, stream_panel(idx, query, status="rendering"))
+        rendered = await asyncio.to_thread(render_markdown, answer)
+        rendered_updates = await asyncio.gather(*(
+            asyncio.to_thread(render_markdown, f"```\n{new_code}\n```")
+            for _, new_code in updates
+        ))
+        header = Text.from_markup(f"[dim]\n=== Answer #{idx} ===[/dim] Q: {query}", style="dim")
+        console.print(Group(header, rendered))
+
+        # 5) Check for [FILE_UPDATE]
+        for (fname, new_code), rendered_code in zip(updates, rendered_updates):
+            async with self.confirm_lock:
+                confirm = await self.board.confirm(
+                    "Apply this update? [y/N] ",
+                    Text.from_markup(f"\n[bold yellow]AI suggests updating file:[/bold yellow] {fname}"),
+                    Text("Proposed new content:\n", style="dim"),
+                    rendered_code
+                )
+                if confirm.strip().lower() == 'y':
+                    update_file_contents(fname, new_code)
+                    console.print(f"File {fname} has been updated.\n", style="bold green")
 
-        # 4) Print answer
-        with global_lock:
-            if answer:
-                console.print("[dim]\n=== Answer ===[/dim]", style="dim")
-                console.print(Markdown(answer))
 
-                # 5) Check for [FILE_UPDATE]
-                updates = parse_file_update_instructions(answer)
-                for fname, new_code in updates:
-                    console.print(
-                        f"\n[bold yellow]AI suggests updating file:[/bold yellow] {fname}",
-                        style="bold yellow"
+class AnswerBoard:
+    """
+    The live view of the questions in flight: one panel per question, the
+    oldest MAX_STREAM_PANELS of them shown. It takes no room when idle.
+    """
+
+    def __init__(self):
+        self.panels = {}
+        self.live = None
+        self._stdout = None
+        self._original = None
+
+    def _start_live(self):
+        # A new Live each time: a restarted one would first erase as many
+        # lines as it drew before it was stopped.
+        self.live = Live(
+            self._render(), console=console, refresh_per_second=10, transient=True
+        )
+        self.live.start()
+
+    def __enter__(self):
+        # Like patch_stdout(raw=True): prints go above the Q: prompt.
+        self._original = sys.stdout, sys.stderr
+        self._stdout = sys.stdout = sys.stderr = StdoutProxy(raw=True)
+        self._start_live()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.live.stop()
+        sys.stdout, sys.stderr = self._original
+        self._stdout.close()
+
+    async def confirm(self, question, *renderables):
+        """
+        Prints renderables and asks question, with the live panels and the
+        Q: prompt hidden. Returns the line typed by the user.
+        """
+        self.live.stop()
+        # The proxy writes prints from a background thread, so they can still
+        # be on their way. Closing it waits for them; a new proxy takes over.
+        previous = self._stdout
+        self._stdout = sys.stdout = sys.stderr = StdoutProxy(raw=True)
+        previous.flush()
+        await asyncio.to_thread(previous.close)
+
+        def ask():
+            # The terminal is ours until ask() returns; write to it directly.
+            terminal = Console(file=self._original[0])
+            for renderable in renderables:
+                terminal.print(renderable)
+            return input(question)
+
+        try:
+            return await run_in_terminal(ask, in_executor=True)
+        finally:
+            self._start_live()
+
+    def _render(self):
+        return Group(*list(self.panels.values())[:MAX_STREAM_PANELS])
+
+    def show(self, idx, panel):
+        self.panels[idx] = panel
+        self.live.update(self._render())
+
+    def remove(self, idx):
+        self.panels.pop(idx, None)
+        self.live.update(self._render())
+
+
+def stream_panel(idx, query, text="", status=""):
+    """
+    Returns the panel shown for question #idx: the last lines of the answer
+    streamed so far, in STREAM_PANEL_HEIGHT rows.
+    """
+    tail = "\n".join(text.splitlines()[-(STREAM_PANEL_HEIGHT - 2):])
+    return Panel(
+        Text(tail),
+        title=f"#{idx} {query}",
+        title_align="left",
+        subtitle=status,
+        subtitle_align="right",
+        height=STREAM_PANEL_HEIGHT
+    )
+
+
+async def ask_session(retriever, sem_cache):
+    """
+    Reads questions with an async prompt and answers each one in its own task
+    until the user presses Ctrl+C (or Ctrl+D). Answers are printed above the
+    prompt, with a live panel per question showing its answer while it streams.
+    """
+    # Cache lookup and retrieval for a question start as soon as it is asked,
+    # so they overlap with the model answering the questions before it.
+    retrieval_pool = ThreadPoolExecutor(max_workers=NUM_WORKERS)
+    session = PromptSession()
+
+    console.print(
+        "\n[bold dim]You can now ask questions about the project codebase.[/bold dim]\n"
+        " - Type your question and press Enter.\n"
+        " - Press Ctrl+C to exit.\n",
+        style="dim"
+    )
+
+    # One client per session: its keep-alive connection pool is reused by
+    # every question, but belongs to this session's event loop.
+    async with AsyncClient() as client:
+        board = AnswerBoard()
+        handler = QuestionHandler(client, get_encoding(), sem_cache, board)
+        pending = set()
+        question_counter = 0
+        with board:
+            try:
+                while True:
+                    user_query = await session.prompt_async("Q: ")
+                    if not user_query.strip():
+                        console.print("[gray]Empty question. Try again or Ctrl+C to exit.[/gray]")
+                        continue
+                    question_counter += 1
+                    prepared = retrieval_pool.submit(prepare_query, user_query, retriever, sem_cache)
+                    task = asyncio.create_task(
+                        handler.answer(user_query, question_counter, prepared)
                     )
-                    console.print("Proposed new content:\n", style="dim")
-                    console.print(Markdown(f"```\n{new_code}\n```"))
-                    confirm = input("Apply this update? [y/N] ").strip().lower()
-                    if confirm == 'y':
-                        update_file_contents(fname, new_code)
-                        console.print(f"File {fname} has been updated.\n", style="bold green")
-            else:
-                console.print("No answer was returned. Something went wrong.", style="bold red")
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+            except (KeyboardInterrupt, EOFError):
+                console.print("\nInterrupted by user.\n", style="bold yellow")
+
+            # Let the questions already asked finish.
+            await asyncio.gather(*pending)
+    retrieval_pool.shutdown()
 
 
 # ------------------------------------------------------------------------------
@@ -339,15 +1121,12 @@ def main():
 
     # Main loop: choosing an index
     while True:
-        subfolders = []
-        for entry in os.scandir(base_dir):
-            if entry.is_dir():
-                subfolders.append(entry.name)
+        with os.scandir(base_dir) as entries:
+            subfolders = sorted(e.name for e in entries if e.is_dir(follow_symlinks=False))
         if not subfolders:
             console.print("No indexes found. Exiting.", style="bold red")
             break
 
-        subfolders.sort()
         radio_values = []
         for folder_name in subfolders:
             proj, dt_str = parse_date_time(folder_name)
@@ -379,53 +1158,34 @@ def main():
         if action == "use":
             console.print("Loading index for Q&A...", style="dim")
             try:
-                embeddings = OllamaEmbeddings(model="llama3.2-vision:latest")
+                get_encoding()
+            except Exception as e:
+                console.print(f"Cannot load the tiktoken tokenizer: {e}", style="bold red")
+                continue
+            try:
+                embeddings = get_embeddings()
                 db = Chroma(
                     collection_name=index_choice,
                     embedding_function=embeddings,
                     persist_directory=chosen_path
                 )
+                retriever = build_retriever(db, embeddings, chosen_path)
             except Exception as e:
                 console.print(f"Error loading {chosen_path}: {e}", style="bold red")
                 continue
 
-            retriever = db.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": K}
-            )
-            enc = tiktoken.get_encoding("cl100k_base")
-
-            task_queue = queue.Queue(maxsize=QUEUE_SIZE)
-            workers = []
-            for _ in range(NUM_WORKERS):
-                w = AskWorker(task_queue, retriever, enc)
-                w.start()
-                workers.append(w)
-
-            console.print(
-                "\n[bold dim]You can now ask questions about the project codebase.[/bold dim]\n"
-                " - Type your question and press Enter.\n"
-                " - Press Ctrl+C to exit.\n",
-                style="dim"
-            )
+            try:
+                sem_cache = SemanticCache(QACacheStore(os.path.join(chosen_path, QA_CACHE_FILE)))
+            except sqlite3.Error as e:
+                console.print(f"Answers will not be cached on disk: {e}", style="yellow")
+                sem_cache = SemanticCache()
 
-            question_counter = 0
             try:
-                while True:
-                    user_query = input("Q: ")
-                    if not user_query.strip():
-                        console.print("[gray]Empty question. Try again or Ctrl+C to exit.[/gray]")
-                        continue
-                    question_counter += 1
-                    task_queue.put((user_query, question_counter))
+                asyncio.run(ask_session(retriever, sem_cache))
             except KeyboardInterrupt:
                 console.print("\nInterrupted by user.\n", style="bold yellow")
 
-            for _ in range(NUM_WORKERS):
-                task_queue.put(None)
-            task_queue.join()
-            for w in workers:
-                w.join()
+            sem_cache.close()
 
             console.print("Done with Q&A.\n", style="dim")
 
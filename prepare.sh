@@ -28,6 +28,10 @@ pip install \
     tqdm \
     rich \
     tiktoken \
+    numpy \
+    zstandard \
+    sqlite-vec \
+    sentence-transformers \
     langchain_ollama \
     langchain_chroma \
     langchain_community \